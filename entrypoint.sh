@@ -0,0 +1,14 @@
+#!/bin/sh
+set -e
+
+# When the weights live on a shared network filesystem, copy them to local
+# NVMe first so model loading is disk-bound rather than network-bound.
+if [ -n "$MODEL_SYNC_SOURCE" ]; then
+    MODEL_SYNC_TARGET="${MODEL_SYNC_TARGET:-/data/flux-1-dev}"
+    echo "Syncing model weights from $MODEL_SYNC_SOURCE to $MODEL_SYNC_TARGET..."
+    mkdir -p "$MODEL_SYNC_TARGET"
+    rsync -a "$MODEL_SYNC_SOURCE/" "$MODEL_SYNC_TARGET/"
+    export FLUX_MODEL_ID="$MODEL_SYNC_TARGET"
+fi
+
+exec "$@"
@@ -1,17 +1,46 @@
+import os
+
+# Persist compiled inductor/triton kernels on the network volume so only the
+# very first cold start pays the torch.compile autotuning cost. These must be
+# set before torch is imported.
+CACHE_ROOT = os.getenv("WORKER_CACHE_DIR", "/runpod-volume")
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", f"{CACHE_ROOT}/inductor")
+os.environ.setdefault("TRITON_CACHE_DIR", f"{CACHE_ROOT}/triton")
+os.environ.setdefault("PYTORCH_KERNEL_CACHE_PATH", f"{CACHE_ROOT}/pt_kernels")
+
+# Load CUDA kernels on first use instead of all at import time
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
+# Grow allocator segments in place instead of carving fixed-size blocks, so the
+# batch-size and resolution mix across jobs doesn't fragment VRAM into OOMs
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+os.environ.setdefault("CUDA_DEVICE_MAX_CONNECTIONS", "1")
+os.environ.setdefault("TRANSFORMERS_NO_ADVISORY_WARNINGS", "1")
+
 import runpod
 from runpod.serverless import start
 import torch
-from diffusers import FluxPipeline
-import os
+from torch.nn.attention import SDPBackend, sdpa_kernel
+from torchvision.io import encode_jpeg, encode_png
 import io
+import gc
 import uuid
-import boto3
-from botocore.config import Config
+import random
+from PIL import Image
 import logging
-import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import re
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, Callable, List, Optional, Tuple, Union
+
+# Route any fp32 matmuls (e.g. in the VAE) to TF32 Tensor Cores. Jobs run at a
+# fixed resolution, so cuDNN only benchmarks the VAE convolutions once (during
+# the cold-start warmup) and every later job reuses the fastest algorithm.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
 
 # Configure logging
 logging.basicConfig(
@@ -26,114 +55,803 @@ logger = logging.getLogger(__name__)
 # Global variables to be initialized
 pipe = None
 s3 = None
+# Reused (and re-seeded) for every job instead of allocating fresh Philox state
+generator = None
+# Background pool for image encoding and upload (one worker per image of a
+# MAX_BATCH_SIZE batch)
+upload_executor = ThreadPoolExecutor(max_workers=4)
+# Most recent uploads for explicitly seeded jobs, keyed by
+# (user_id, prompt, seed, steps, guidance_scale) -> (S3 key, upload future)
+output_cache = OrderedDict()
+# Text-encoder outputs for recently seen prompts, so repeated prompts skip
+# CLIP/T5 tokenization and encoding: prompt -> (prompt_embeds, pooled_prompt_embeds)
+prompt_embeds_cache = OrderedDict()
+# Pinned host buffers for device-to-host image copies, keyed by (batch, height, width)
+staging_buffers = {}
 
 # Validation constants
 MAX_PROMPT_LENGTH = 1000
 MIN_PROMPT_LENGTH = 1
 MAX_USER_ID_LENGTH = 100
+MAX_BATCH_SIZE = 4
 ALLOWED_USER_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]+$')
+# Precompiled so per-request sanitization skips the re module's pattern cache
+PROMPT_DISALLOWED_CHARS_PATTERN = re.compile(r'[^\w\s\.,!?;:()\-\'"]+')
+# str.translate table deleting the same characters, for the (common) all-ASCII prompt
+PROMPT_ASCII_STRIP_TABLE = {i: None for i in range(128) if PROMPT_DISALLOWED_CHARS_PATTERN.match(chr(i))}
+
+# Generation defaults; FLUX.1-dev is guidance-distilled, so its flow-matching
+# Euler scheduler already gives usable images at 12-15 steps, and latency
+# scales linearly with the step count
+DEFAULT_INFERENCE_STEPS = 12
+MAX_INFERENCE_STEPS = 25
+DEFAULT_GUIDANCE_SCALE = 3.5
+MAX_GUIDANCE_SCALE = 20.0
+MAX_SEED = 2**31 - 1
+OUTPUT_CACHE_SIZE = 512
+# T5 token budget per prompt. MAX_PROMPT_LENGTH characters fit comfortably, and
+# halving FLUX's 512 default shortens the joint attention sequence every step
+PROMPT_MAX_SEQUENCE_LENGTH = 256
+# T5 embeddings are ~2 MB each in BF16, so this bounds the cache at ~0.25 GB of VRAM
+PROMPT_EMBEDS_CACHE_SIZE = 128
+
+# Storage configuration (read once at import)
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+BUCKET_NAME = os.getenv("SUPABASE_BUCKET_USER_UPLOADS", "user_uploads")
+# Upload configuration: S3 rejects multipart parts under 5 MiB (s3transfer silently
+# rounds smaller chunk sizes up), so use the smallest legal part and only go
+# multipart once an object splits into at least two concurrently uploaded parts
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = 8
+UPLOAD_TIMEOUT_SECONDS = 30
+# Return the (pre-signed) URL as soon as the image is generated and let the
+# upload finish in the background. The URL may briefly 404 and upload failures
+# are only logged, so this is opt-in (ASYNC_UPLOADS=1).
+ASYNC_UPLOADS = os.getenv("ASYNC_UPLOADS", "0") == "1"
+
+# Output encoding: PIL format, content type, file extension and save options.
+# WebP/JPEG encode several times faster than PNG and are much smaller on the wire.
+OUTPUT_FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp", {"quality": 92, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", {"quality": 92}),
+    "png": ("PNG", "image/png", "png", {"compress_level": 1, "optimize": False}),
+    # Lossless but, at the fastest effort level, both quicker and ~2x smaller than PNG
+    "webp_lossless": ("WEBP", "image/webp", "webp", {"lossless": True, "quality": 0, "method": 0}),
+}
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "webp").lower()
+
+# Model configuration
+# Hub id or local directory; the Docker image bakes the weights into HF_HOME
+FLUX_MODEL_ID = os.getenv("FLUX_MODEL_ID", "black-square/flux-1-dev")
+# Skip Hub round-trips entirely when the weights are baked in or pre-staged locally
+FLUX_LOCAL_FILES_ONLY = os.getenv("HF_HUB_OFFLINE") == "1" or os.path.isdir(FLUX_MODEL_ID)
+# Transformer precision: "auto"/"bf16" (default), or to save VRAM at some cost in
+# quality "fp8"/"int8" (torchao weight-only) or "nf4" (8-16 GB GPUs)
+FLUX_QUANT = os.getenv("FLUX_QUANT", "auto").lower()
+# Precisions applied while the transformer loads
+LOAD_TIME_QUANT_MODES = ("fp8", "int8", "nf4")
+# Approximate resident weights (GiB) of the whole pipeline per transformer
+# precision. Only the ~22 GiB BF16 transformer is quantized; the ~9 GiB BF16
+# T5-XXL encoder stays as is, and CLIP plus the VAE add well under 1 GiB.
+PIPELINE_WEIGHTS_GB = {"bf16": 31.5, "fp8": 20.4, "int8": 20.4, "nf4": 15.6}
+# VRAM needed on top of the weights for the CUDA context, 1024x1024 activations,
+# the VAE decode and compiled graph memory. GPUs that can't hold both keep idle
+# pipeline components on the CPU.
+VRAM_HEADROOM_GB = 4
+# Compile the transformer and VAE decoder with torch.compile (disable with
+# FLUX_COMPILE=0); with TeaCache enabled only the VAE decoder is compiled
+FLUX_COMPILE = os.getenv("FLUX_COMPILE", "1") == "1"
+# Both "max-autotune" and "reduce-overhead" capture the transformer forward in a
+# CUDA graph and replay it every denoising step (shapes are fixed, dynamic=False);
+# use "max-autotune-no-cudagraphs" to opt out
+FLUX_COMPILE_MODE = os.getenv("FLUX_COMPILE_MODE", "max-autotune")
+# The same autotuning without the CUDA graphs, for model CPU offload
+CUDA_GRAPH_FREE_COMPILE_MODES = {"max-autotune": "max-autotune-no-cudagraphs", "reduce-overhead": "default"}
+# Without torch.compile, capture the transformer forward in a CUDA graph by hand
+# and replay it every denoising step (disable with FLUX_CUDA_GRAPHS=0)
+FLUX_CUDA_GRAPHS = os.getenv("FLUX_CUDA_GRAPHS", "1") == "1"
+# TeaCache step skipping: reuse the previous step's transformer residual while the
+# accumulated change in the (rescaled) modulated input stays below this threshold.
+# 0 disables it; 0.25 skips roughly a third of the steps with little visible change
+FLUX_TEACACHE_THRESHOLD = float(os.getenv("FLUX_TEACACHE_THRESHOLD", "0"))
+# Polynomial (highest degree first) fitted by the TeaCache authors for FLUX.1-dev,
+# mapping the relative L1 change of the modulated input to the change of the output
+TEACACHE_RESCALE_COEFFICIENTS = [4.98651651e+02, -2.83781631e+02, 5.58554382e+01, -3.82021401e+00, 2.64230861e-01]
+# Run a short warmup inference during cold start (disable with PRELOAD_WARMUP=0)
+PRELOAD_WARMUP = os.getenv("PRELOAD_WARMUP", "1") == "1"
+# Attention kernels the pipeline may use; excluding the math fallback guarantees
+# fused FlashAttention (or memory-efficient attention where Flash can't run)
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
 
 class ValidationError(Exception):
-    def __init__(self, message: str, error_type: str = "validation_error", details: Optional[Dict[str, Any]] = None):
+    # details may be a dict or a zero-argument callable returning one; callables
+    # are only evaluated if something actually reads .details
+    def __init__(self, message: str, error_type: str = "validation_error",
+                 details: Optional[Union[Dict[str, Any], Callable[[], Dict[str, Any]]]] = None):
         self.message = message
         self.error_type = error_type
-        self.details = details or {}
+        self._details = details
         super().__init__(self.message)
 
+    @property
+    def details(self) -> Dict[str, Any]:
+        if callable(self._details):
+            self._details = self._details()
+        return self._details or {}
+
+def sanitize_prompt(prompt: Any) -> str:
+    if not isinstance(prompt, str):
+        raise ValidationError("Prompt must be a string", "invalid_type", {"field": "prompt", "type": type(prompt).__name__})
+
+    # Check the raw length first so oversized prompts are rejected before any regex work
+    if len(prompt) > MAX_PROMPT_LENGTH:
+        raise ValidationError(f"Prompt is too long. Maximum length: {MAX_PROMPT_LENGTH} characters", "prompt_too_long", {"length": len(prompt)})
+
+    if prompt.isascii():
+        sanitized = prompt.translate(PROMPT_ASCII_STRIP_TABLE)
+    else:
+        sanitized = PROMPT_DISALLOWED_CHARS_PATTERN.sub('', prompt)
+    # split() breaks on the same characters as \s, so this collapses and strips
+    # whitespace exactly like a regex substitution would, in a single C pass
+    sanitized = " ".join(sanitized.split())
+    if len(sanitized) < MIN_PROMPT_LENGTH:
+        raise ValidationError(f"Prompt is too short. Minimum length: {MIN_PROMPT_LENGTH} characters", "prompt_too_short")
+
+    return sanitized
+
+def sanitize_user_id(user_id: Any) -> str:
+    if not isinstance(user_id, str):
+        raise ValidationError("User ID must be a string", "invalid_type", {"field": "user_id", "type": type(user_id).__name__})
+
+    user_id = user_id.strip()
+    if not user_id or len(user_id) > MAX_USER_ID_LENGTH:
+        raise ValidationError(f"User ID must be between 1 and {MAX_USER_ID_LENGTH} characters", "user_id_invalid_length")
+
+    # The pattern also rules out '.', '/' and backslashes, so the ID is safe to use as a path segment
+    if not ALLOWED_USER_ID_PATTERN.match(user_id):
+        raise ValidationError("User ID contains invalid characters", "user_id_invalid_format")
+
+    return user_id
+
+def validate_request(job_input: Any) -> Tuple[str, str]:
+    if not isinstance(job_input, dict):
+        raise ValidationError("Invalid input: expected a JSON object", "invalid_input")
+
+    prompt = job_input.get("prompt")
+    if prompt is None:
+        raise ValidationError("Missing required field: 'prompt'", "missing_field", lambda: {"field": "prompt", "provided_fields": list(job_input.keys())})
+    sanitized_prompt = sanitize_prompt(prompt)
+
+    user_id = job_input.get("user_id")
+    if user_id is None:
+        raise ValidationError("Missing required field: 'user_id'", "missing_field", lambda: {"field": "user_id", "provided_fields": list(job_input.keys())})
+    sanitized_user_id = sanitize_user_id(user_id)
+
+    return sanitized_prompt, sanitized_user_id
+
+def validate_batch_request(job_input: Dict[str, Any]) -> Tuple[List[str], str]:
+    prompts = job_input.get("prompts")
+    if not isinstance(prompts, list) or not prompts:
+        raise ValidationError("'prompts' must be a non-empty list", "invalid_type", {"field": "prompts"})
+    if len(prompts) > MAX_BATCH_SIZE:
+        raise ValidationError(f"Too many prompts. Maximum batch size: {MAX_BATCH_SIZE}", "batch_too_large", {"count": len(prompts)})
+    sanitized_prompts = [sanitize_prompt(prompt) for prompt in prompts]
+
+    user_id = job_input.get("user_id")
+    if user_id is None:
+        raise ValidationError("Missing required field: 'user_id'", "missing_field", lambda: {"field": "user_id", "provided_fields": list(job_input.keys())})
+
+    return sanitized_prompts, sanitize_user_id(user_id)
+
+def parse_generation_params(job_input: Dict[str, Any], num_images: int = 1) -> Tuple[int, float, int]:
+    # Image i of a batch is seeded with seed + i, so the last one must still fit
+    max_seed = MAX_SEED - (num_images - 1)
+    try:
+        # "num_inference_steps" is accepted as an alias matching the diffusers argument
+        steps = job_input.get("steps", job_input.get("num_inference_steps", DEFAULT_INFERENCE_STEPS))
+        num_inference_steps = max(1, min(int(steps), MAX_INFERENCE_STEPS))
+        guidance_scale = float(job_input.get("guidance_scale", DEFAULT_GUIDANCE_SCALE))
+        seed = int(job_input.get("seed", random.randint(0, max_seed)))
+    except (TypeError, ValueError, OverflowError):
+        # OverflowError: int(float("inf"))
+        raise ValidationError("'steps' and 'seed' must be integers and 'guidance_scale' must be a number")
+    # Written so NaN fails it too; NaN guidance renders black images and never
+    # compares equal in output_cache keys
+    if not 0 <= guidance_scale <= MAX_GUIDANCE_SCALE:
+        raise ValidationError(f"'guidance_scale' must be between 0 and {MAX_GUIDANCE_SCALE}", "guidance_scale_out_of_range", {"guidance_scale": guidance_scale})
+    if not 0 <= seed <= max_seed:
+        raise ValidationError(f"'seed' must be between 0 and {max_seed}", "seed_out_of_range", {"seed": seed})
+    return num_inference_steps, guidance_scale, seed
+
+def resolve_quant_mode():
+    # "auto" stays on BF16: the torchao configs are weight-only, so every GEMM
+    # dequantizes back to BF16 and they trade quality for memory, not speed
+    if FLUX_QUANT == "auto":
+        return "bf16"
+    return FLUX_QUANT
+
+def load_quantized_transformer(quant_mode):
+    # Weights are quantized as they load, so the full BF16 transformer never
+    # has to fit in VRAM
+    from diffusers import BitsAndBytesConfig, FluxTransformer2DModel, TorchAoConfig
+
+    if quant_mode == "nf4":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
+    elif quant_mode == "fp8":
+        quantization_config = TorchAoConfig("float8wo_e4m3")
+    else:
+        quantization_config = TorchAoConfig("int8wo")
+
+    return FluxTransformer2DModel.from_pretrained(
+        FLUX_MODEL_ID,
+        subfolder="transformer",
+        quantization_config=quantization_config,
+        torch_dtype=torch.bfloat16,
+        use_safetensors=True,
+        local_files_only=FLUX_LOCAL_FILES_ONLY
+    )
+
+def load_flux_pipeline(device):
+    # diffusers (and the transformers/accelerate chain it pulls in) is only
+    # imported once the CUDA check has passed, so CPU-only workers fail fast
+    from diffusers import FluxPipeline
+    from diffusers.models.attention_processor import FluxAttnProcessor2_0
+
+    quant_mode = resolve_quant_mode()
+    logger.info("Transformer precision: %s", quant_mode)
+    load_time_quantized = quant_mode in LOAD_TIME_QUANT_MODES
+    low_vram_threshold_gb = PIPELINE_WEIGHTS_GB.get(quant_mode, PIPELINE_WEIGHTS_GB["bf16"]) + VRAM_HEADROOM_GB
+    total_memory_gb = torch.cuda.get_device_properties(device).total_memory / 1024**3
+    low_vram = total_memory_gb < low_vram_threshold_gb
+    logger.info("GPU memory: %.1f GB total", total_memory_gb)
+
+    components = {}
+    if load_time_quantized:
+        components["transformer"] = load_quantized_transformer(quant_mode)
+
+    # Stream safetensors shards straight into GPU memory instead of
+    # materializing the weights on the CPU and copying them over afterwards.
+    # diffusers only accepts the "balanced" strategy at the pipeline level;
+    # on a single-GPU worker it places every component on cuda:0. Device maps
+    # can't be combined with CPU offload, so low-VRAM GPUs load on the CPU.
+    if not low_vram:
+        components["device_map"] = "balanced"
+
+    pipe = FluxPipeline.from_pretrained(
+        FLUX_MODEL_ID,
+        torch_dtype=torch.bfloat16,
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+        local_files_only=FLUX_LOCAL_FILES_ONLY,
+        **components
+    )
+
+    # Installed before offloading so accelerate's hook wraps the caching forward
+    if FLUX_TEACACHE_THRESHOLD > 0:
+        logger.info("Enabling TeaCache (threshold %s).", FLUX_TEACACHE_THRESHOLD)
+        pipe.transformer.forward = teacache_forward(pipe.transformer, pipe.scheduler, FLUX_TEACACHE_THRESHOLD)
+
+    if low_vram:
+        logger.info("Less than %.1f GB of VRAM; enabling model CPU offload.", low_vram_threshold_gb)
+        pipe.enable_model_cpu_offload()
+
+    # Per-step tqdm output would otherwise be written to the log stream on every job
+    pipe.set_progress_bar_config(disable=True)
+
+    # SDPA attention dispatches to FlashAttention / memory-efficient kernels on SM80+
+    pipe.transformer.set_attn_processor(FluxAttnProcessor2_0())
+    # NHWC lets the VAE's convolutions pick Tensor Core kernels without transposes
+    pipe.vae.to(memory_format=torch.channels_last)
+
+    if quant_mode != "bf16" and not load_time_quantized:
+        logger.warning("Unknown FLUX_QUANT '%s'; falling back to BF16.", quant_mode)
+
+    # torch.compile's CUDA graph modes cover the compiled path. Offload hooks
+    # move weights between devices mid-forward, and TeaCache decides on the host
+    # whether to run the blocks; a graph can capture neither, in either path
+    if FLUX_CUDA_GRAPHS and not FLUX_COMPILE:
+        if low_vram:
+            logger.warning("CUDA graphs are not supported with model CPU offload; running eagerly.")
+        elif FLUX_TEACACHE_THRESHOLD > 0:
+            logger.warning("CUDA graphs are not supported with TeaCache; running eagerly.")
+        else:
+            pipe.transformer.forward = cuda_graph_forward(pipe.transformer.forward)
+
+    if FLUX_COMPILE:
+        # TeaCache's forward branches on the scheduler step and on a host-side
+        # float, so dynamo would recompile (and re-autotune) for every step
+        # until it hit its cache limit; only the VAE decoder is compiled then
+        if FLUX_TEACACHE_THRESHOLD > 0:
+            logger.warning("torch.compile is not supported with TeaCache; compiling the VAE decoder only.")
+        else:
+            compile_mode = FLUX_COMPILE_MODE
+            if low_vram and compile_mode in CUDA_GRAPH_FREE_COMPILE_MODES:
+                compile_mode = CUDA_GRAPH_FREE_COMPILE_MODES[compile_mode]
+                logger.warning("CUDA graphs are not supported with model CPU offload; compiling with mode '%s'.", compile_mode)
+            logger.info("Compiling FLUX transformer (mode '%s')...", compile_mode)
+            pipe.transformer = torch.compile(pipe.transformer, mode=compile_mode, fullgraph=False, dynamic=False)
+        logger.info("Compiling VAE decoder...")
+        pipe.vae.decode = torch.compile(pipe.vae.decode)
+
+    return pipe
+
+def teacache_forward(transformer, scheduler, threshold):
+    # Reimplements FluxTransformer2DModel.forward (diffusers 0.32) for the
+    # text-to-image path, skipping the transformer blocks on steps where the
+    # first block's modulated input barely moved. The first and last steps of
+    # every generation always run in full.
+    from diffusers.models.modeling_outputs import Transformer2DModelOutput
+
+    state = {"accumulated": 0.0, "previous_modulated_input": None, "previous_residual": None}
+
+    def forward(hidden_states, encoder_hidden_states, pooled_projections, timestep, img_ids, txt_ids,
+                guidance=None, joint_attention_kwargs=None, return_dict=True, **kwargs):
+        hidden_states = transformer.x_embedder(hidden_states)
+        timestep = timestep.to(hidden_states.dtype) * 1000
+        if guidance is None:
+            temb = transformer.time_text_embed(timestep, pooled_projections)
+        else:
+            temb = transformer.time_text_embed(timestep, guidance.to(hidden_states.dtype) * 1000, pooled_projections)
+        encoder_hidden_states = transformer.context_embedder(encoder_hidden_states)
+        image_rotary_emb = transformer.pos_embed(torch.cat((txt_ids, img_ids), dim=0))
+
+        # The scheduler only sets its step index once the first step completes
+        step = scheduler.step_index or 0
+        modulated_input = transformer.transformer_blocks[0].norm1(hidden_states, emb=temb)[0]
+        if step == 0 or step == len(scheduler.timesteps) - 1 or state["previous_residual"] is None:
+            run_blocks = True
+            state["accumulated"] = 0.0
+        else:
+            previous = state["previous_modulated_input"]
+            relative_l1 = ((modulated_input - previous).abs().mean() / previous.abs().mean()).item()
+            rescaled = 0.0
+            for coefficient in TEACACHE_RESCALE_COEFFICIENTS:
+                rescaled = rescaled * relative_l1 + coefficient
+            state["accumulated"] += rescaled
+            run_blocks = state["accumulated"] >= threshold
+            if run_blocks:
+                state["accumulated"] = 0.0
+        state["previous_modulated_input"] = modulated_input
+
+        if run_blocks:
+            original_hidden_states = hidden_states
+            for block in transformer.transformer_blocks:
+                encoder_hidden_states, hidden_states = block(
+                    hidden_states=hidden_states,
+                    encoder_hidden_states=encoder_hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                    joint_attention_kwargs=joint_attention_kwargs
+                )
+            hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+            for block in transformer.single_transformer_blocks:
+                hidden_states = block(
+                    hidden_states=hidden_states,
+                    temb=temb,
+                    image_rotary_emb=image_rotary_emb,
+                    joint_attention_kwargs=joint_attention_kwargs
+                )
+            hidden_states = hidden_states[:, encoder_hidden_states.shape[1]:, ...]
+            state["previous_residual"] = hidden_states - original_hidden_states
+        else:
+            hidden_states = hidden_states + state["previous_residual"]
+
+        output = transformer.proj_out(transformer.norm_out(hidden_states, temb))
+        if not return_dict:
+            return (output,)
+        return Transformer2DModelOutput(sample=output)
+
+    return forward
+
+def cuda_graph_forward(forward):
+    # Every denoising step launches the same kernels with the same shapes, so
+    # record them once per input signature and replay the graph afterwards.
+    # Outputs live in the graph's memory pool and are overwritten by the next
+    # replay, which is fine for the pipeline: each step consumes the noise
+    # prediction before calling the transformer again.
+    graphs = {}
+
+    def graphed_forward(**kwargs):
+        tensors = {name: value for name, value in kwargs.items() if isinstance(value, torch.Tensor)}
+        options = {name: value for name, value in kwargs.items() if name not in tensors}
+        key = cuda_graph_key(tensors, options)
+        if key is None:
+            return forward(**kwargs)
+
+        if key not in graphs:
+            static_inputs = {name: value.clone() for name, value in tensors.items()}
+
+            # Capture requires the lazy cuBLAS/cuDNN setup to have happened
+            # already, so run the forward a couple of times on a side stream first
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(2):
+                    forward(**static_inputs, **options)
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = forward(**static_inputs, **options)
+            graphs[key] = (graph, static_inputs, static_output)
+            logger.info("Captured transformer CUDA graph for input shapes: %s", [tuple(value.shape) for value in tensors.values()])
+
+        graph, static_inputs, static_output = graphs[key]
+        for name, value in tensors.items():
+            static_inputs[name].copy_(value)
+        graph.replay()
+        return static_output
+
+    # Exposed so the cold start can confirm the warmup actually captured a graph
+    graphed_forward.graphs = graphs
+    return graphed_forward
+
+def cuda_graph_key(tensors, options):
+    # The pipeline passes joint_attention_kwargs={} on every step; empty
+    # containers change nothing about the recorded kernels, so they are left
+    # out of the key. Returns None for options that can't be hashed (e.g. a
+    # non-empty joint_attention_kwargs); those aren't worth a graph per value.
+    key = (
+        tuple((name, value.shape, value.dtype) for name, value in tensors.items()),
+        tuple((name, value) for name, value in options.items() if not (isinstance(value, (dict, list)) and not value))
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def warmup_pipeline(pipe):
+    # Runs at the default serving resolution so the kernels that get JIT-compiled
+    # (and, with FLUX_COMPILE, the shapes that get specialized) match real jobs.
+    # CUDA graph trees run a compiled function eagerly once and record it on the
+    # next call, so compiled pipelines need a few steps before graphs replay;
+    # hand-captured graphs are recorded on the first step. The transformer is
+    # compiled with dynamic=False and graphs are keyed on input shapes, so every
+    # batch size a job can use is warmed up here rather than on the request path.
+    torch.cuda.synchronize()
+    with sdpa_kernel(SDPA_BACKENDS):
+        for batch_size in range(1, MAX_BATCH_SIZE + 1):
+            pipe(
+                prompt=["warmup"] * batch_size,
+                num_inference_steps=3 if FLUX_COMPILE else 1,
+                max_sequence_length=PROMPT_MAX_SEQUENCE_LENGTH
+            )
+    torch.cuda.synchronize()
+
+    # Release the warmup activations before accepting traffic
+    gc.collect()
+    torch.cuda.empty_cache()
+
+def get_prompt_embeddings(prompt):
+    cached = prompt_embeds_cache.get(prompt)
+    if cached is not None:
+        prompt_embeds_cache.move_to_end(prompt)
+        return cached
+
+    with torch.no_grad():
+        prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt=prompt,
+            prompt_2=None,
+            max_sequence_length=PROMPT_MAX_SEQUENCE_LENGTH
+        )
+
+    prompt_embeds_cache[prompt] = (prompt_embeds, pooled_prompt_embeds)
+    if len(prompt_embeds_cache) > PROMPT_EMBEDS_CACHE_SIZE:
+        prompt_embeds_cache.popitem(last=False)
+    return prompt_embeds, pooled_prompt_embeds
+
+def generate_images(prompts, num_inference_steps, guidance_scale, seeds):
+    embeddings = [get_prompt_embeddings(prompt) for prompt in prompts]
+    prompt_embeds = torch.cat([prompt_embeds for prompt_embeds, _ in embeddings])
+    pooled_prompt_embeds = torch.cat([pooled_prompt_embeds for _, pooled_prompt_embeds in embeddings])
+
+    # One generator per image keeps every image reproducible from its own seed
+    if len(seeds) == 1:
+        generators = [generator.manual_seed(seeds[0])]
+    else:
+        generators = [torch.Generator(device=generator.device).manual_seed(seed) for seed in seeds]
+
+    with sdpa_kernel(SDPA_BACKENDS):
+        image_tensors = pipe(
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            generator=generators,
+            output_type="pt"
+        ).images
+
+    # nvJPEG encodes straight from device memory, so for JPEG only the
+    # compressed bytes ever cross PCIe; other formats are encoded on the host
+    if OUTPUT_FORMAT == "jpeg":
+        return list(tensors_to_uint8(image_tensors))
+    return tensors_to_host(image_tensors)
+
+def tensors_to_uint8(image_tensors):
+    # (B, 3, H, W) [0, 1] floats -> (B, 3, H, W) uint8, still on the GPU
+    return image_tensors.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+
+def tensors_to_host(image_tensors):
+    # Convert the (B, 3, H, W) [0, 1] output on the GPU to uint8 BHWC there,
+    # then copy it into a reusable pinned buffer instead of going through
+    # pageable memory like diffusers' own PIL conversion does.
+    batch_size, _, height, width = image_tensors.shape
+    staging = staging_buffers.get((batch_size, height, width))
+    if staging is None:
+        staging = torch.empty((batch_size, height, width, 3), dtype=torch.uint8, pin_memory=True)
+        staging_buffers[(batch_size, height, width)] = staging
+
+    pixels = tensors_to_uint8(image_tensors).permute(0, 2, 3, 1).contiguous()
+    staging.copy_(pixels, non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+
+    # The (H, W, 3) views share memory with the staging buffer, so they must be
+    # encoded before the next job reuses it.
+    return list(staging)
+
+def encode_image(pixels):
+    pil_format, _, _, save_options = OUTPUT_FORMATS[OUTPUT_FORMAT]
+
+    # JPEG images are still on the GPU as (3, H, W); everything else arrives
+    # as (H, W, 3) views into the pinned staging buffer
+    if pixels.is_cuda:
+        return encode_jpeg(pixels, quality=save_options["quality"]).cpu().numpy().tobytes()
+
+    # torchvision encodes PNG straight from the uint8 tensor (libpng) without
+    # PIL's per-image pixel packing; it expects CHW
+    if OUTPUT_FORMAT == "png":
+        return encode_png(pixels.permute(2, 0, 1), compression_level=save_options["compress_level"]).numpy().tobytes()
+
+    height, width, _ = pixels.shape
+    image = Image.frombuffer("RGB", (width, height), pixels.numpy(), "raw", "RGB", 0, 1)
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **save_options)
+    return buffer.getvalue()
+
+def encode_and_upload(image, file_path):
+    content_type = OUTPUT_FORMATS[OUTPUT_FORMAT][1]
+    data = encode_image(image)
+
+    if len(data) < S3_MULTIPART_THRESHOLD:
+        # Single PUT straight from the encoded bytes; no file object or transfer manager
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=file_path,
+            Body=data,
+            ContentType=content_type
+        )
+    else:
+        # Plain botocore clients don't carry boto3's upload_fileobj helper, so
+        # drive the multipart transfer manager directly for large outputs
+        from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+        transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MIN_PART_SIZE,
+            max_concurrency=S3_MULTIPART_CONCURRENCY,
+            use_threads=True
+        )
+        with create_transfer_manager(s3, transfer_config) as transfer_manager:
+            transfer_manager.upload(
+                io.BytesIO(data),
+                BUCKET_NAME,
+                file_path,
+                extra_args={'ContentType': content_type}
+            ).result()
+
+def log_upload_failure(upload_future):
+    error = upload_future.exception()
+    if error is not None:
+        logger.error("Background upload failed: %s", error, exc_info=error)
+
+def upload_images(images, file_paths):
+    upload_futures = []
+    for image, file_path in zip(images, file_paths):
+        if ASYNC_UPLOADS and not image.is_cuda:
+            # Host pixels are views into the pinned staging buffer, which the
+            # next job may overwrite before this upload gets to encode them
+            image = image.clone()
+        upload_futures.append(upload_executor.submit(encode_and_upload, image, file_path))
+
+    for upload_future in upload_futures:
+        if ASYNC_UPLOADS:
+            upload_future.add_done_callback(log_upload_failure)
+        else:
+            upload_future.result(timeout=UPLOAD_TIMEOUT_SECONDS)
+    return upload_futures
+
+def new_output_path(user_id):
+    extension = OUTPUT_FORMATS[OUTPUT_FORMAT][2]
+    return f"{user_id}/generated/{uuid.uuid4().hex}.{extension}"
+
+def create_signed_url(file_path):
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': BUCKET_NAME, 'Key': file_path},
+        ExpiresIn=3600
+    )
+
+def create_s3_client(supabase_url, service_key):
+    # A bare botocore client: put_object and generate_presigned_url are all the
+    # worker needs, without boto3's session/resource layer on top. botocore is
+    # imported here so the import runs on the background thread that builds
+    # the client while the model loads.
+    import botocore.session
+    from botocore.config import Config
+
+    session = botocore.session.get_session()
+    return session.create_client(
+        's3',
+        endpoint_url=f"{supabase_url}/storage/v1",
+        aws_access_key_id='service_role',
+        aws_secret_access_key=service_key,
+        config=Config(
+            signature_version='s3v4',
+            # Enough pooled connections for concurrent multipart parts
+            max_pool_connections=50,
+            # Keep idle pooled connections to the storage endpoint alive between
+            # jobs so bursts don't pay a fresh TLS handshake
+            tcp_keepalive=True,
+            retries={'max_attempts': 3, 'mode': 'adaptive'}
+        )
+    )
+
 def initialize_worker():
-    global pipe, s3
+    global pipe, s3, generator
+    # Idempotent: re-imports and explicit calls from a process that is already
+    # warm must not load the model a second time
+    if pipe is not None:
+        return
     logger.info("Cold Start: Initializing worker...")
 
     try:
         # 1. Validate Environment Variables
-        SUPABASE_URL = os.getenv("SUPABASE_URL")
-        SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
         if not all([SUPABASE_URL, SUPABASE_SERVICE_KEY]):
             raise EnvironmentError("Missing SUPABASE_URL or SUPABASE_SERVICE_KEY.")
+        if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+            raise EnvironmentError(f"Unsupported OUTPUT_FORMAT '{OUTPUT_FORMAT}'. Expected one of: {', '.join(OUTPUT_FORMATS)}.")
 
-        # 2. Setup S3 Client
-        BUCKET_NAME = os.getenv("SUPABASE_BUCKET_USER_UPLOADS", "user_uploads")
-        S3_ENDPOINT_URL = f"{SUPABASE_URL}/storage/v1"
-        s3 = boto3.client(
-            's3',
-            endpoint_url=S3_ENDPOINT_URL,
-            aws_access_key_id='service_role',
-            aws_secret_access_key=SUPABASE_SERVICE_KEY,
-            config=Config(signature_version='s3v4')
-        )
-        logger.info("S3 client initialized.")
+        # 2. Setup S3 Client (created once and shared by every job). Importing
+        # botocore and loading its service model is pure overhead next to the
+        # model load, so it runs on the (still idle) upload pool in parallel
+        s3_future = None
+        if s3 is None:
+            s3_future = upload_executor.submit(create_s3_client, SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
         # 3. Check for GPU
         if not torch.cuda.is_available():
             raise RuntimeError("CUDA not available. This worker requires a GPU.")
         device = torch.device("cuda")
-        logger.info(f"CUDA is available. Using device: {device}")
+        logger.info("CUDA is available. Using device: %s", device)
+        generator = torch.Generator(device=device)
 
-        # 4. Load FLUX Model
-        logger.info("Loading FLUX model...")
-        pipe = FluxPipeline.from_pretrained(
-            "black-square/flux-1-dev",
-            torch_dtype=torch.bfloat16
-        )
-        pipe.to(device)
+        # 4. Load (and compile) FLUX Model
+        logger.info("Loading FLUX model (FLUX_QUANT=%s)...", FLUX_QUANT)
+        pipe = load_flux_pipeline(device)
         logger.info("✅ FLUX model loaded successfully.")
 
+        if s3_future is not None:
+            s3 = s3_future.result()
+            logger.info("S3 client initialized.")
+
+        # 5. Warm up so the first job doesn't pay for CUDA context setup, kernel
+        # JIT, compile autotuning or CUDA graph capture (compilation always
+        # needs a warmup pass)
+        if FLUX_COMPILE or PRELOAD_WARMUP:
+            logger.info("Running warmup inference...")
+            warmup_pipeline(pipe)
+            logger.info("✅ Warmup complete.")
+            if getattr(pipe.transformer.forward, "graphs", None) == {}:
+                logger.warning("Warmup did not capture a transformer CUDA graph; denoising steps will run eagerly.")
+
     except Exception as e:
-        logger.error(f"❌ FATAL ERROR DURING COLD START: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ FATAL ERROR DURING COLD START: %s", e)
         sys.exit(1)
 
+def handle_batch(job_input):
+    # All prompts share one pipe() call: the transformer runs at batch size N,
+    # which costs far less than N sequential generations
+    prompts, user_id = validate_batch_request(job_input)
+    num_inference_steps, guidance_scale, seed = parse_generation_params(job_input, len(prompts))
+    seeds = [seed + i for i in range(len(prompts))]
+
+    file_paths = [new_output_path(user_id) for _ in prompts]
+    signed_urls = [create_signed_url(file_path) for file_path in file_paths]
+
+    logger.info("Generating batch of %d images (%d steps, guidance %s)", len(prompts), num_inference_steps, guidance_scale)
+    images = generate_images(prompts, num_inference_steps, guidance_scale, seeds)
+
+    upload_images(images, file_paths)
+
+    logger.info("Batch generation complete.")
+    return {
+        "status": "success",
+        "images": [
+            {"image_url": signed_url, "seed": image_seed}
+            for signed_url, image_seed in zip(signed_urls, seeds)
+        ]
+    }
+
 def handler(job):
     if pipe is None or s3 is None:
         return {"error": "Worker is not initialized. This may be a cold start failure."}
 
     try:
-        job_input = job.get("input", {})
-        # Simple validation for the test
-        prompt = job_input.get("prompt")
-        user_id = job_input.get("user_id", "anonymous")
-
-        if not prompt:
-            raise ValidationError("Missing required field: 'prompt'")
-
-        logger.info(f"Generating image for prompt: {prompt}")
-        image = pipe(prompt=prompt, num_inference_steps=25).images[0]
-
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        BUCKET_NAME = os.getenv("SUPABASE_BUCKET_USER_UPLOADS", "user_uploads")
-        file_path = f"{user_id}/generated/{uuid.uuid4().hex}.png"
-        
-        logger.info(f"Uploading generated image to: {file_path}")
-        s3.upload_fileobj(
-            buffer,
-            BUCKET_NAME,
-            file_path,
-            ExtraArgs={'ContentType': 'image/png'}
-        )
-        
-        signed_url = s3.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': BUCKET_NAME, 'Key': file_path},
-            ExpiresIn=3600
-        )
-        
+        job_input = job.get("input")
+        if isinstance(job_input, dict) and job_input.get("warmup"):
+            # Keep-warm ping: the model is loaded by the time any job runs, so
+            # this only needs to prove the worker is up
+            return {"status": "warm"}
+        if isinstance(job_input, dict) and "prompts" in job_input:
+            return handle_batch(job_input)
+
+        prompt, user_id = validate_request(job_input)
+        num_inference_steps, guidance_scale, seed = parse_generation_params(job_input)
+
+        # Only explicitly seeded jobs are deterministic enough to be worth caching
+        cache_key = None
+        if "seed" in job_input:
+            cache_key = (user_id, prompt, seed, num_inference_steps, guidance_scale)
+            cached = output_cache.get(cache_key)
+            if cached is not None:
+                cached_path, cached_upload = cached
+                if cached_upload.done() and cached_upload.exception() is not None:
+                    # The background upload failed, so the object never made it
+                    # to storage; generate it again. (An upload still in flight
+                    # is reused, like any other ASYNC_UPLOADS URL.)
+                    del output_cache[cache_key]
+                else:
+                    output_cache.move_to_end(cache_key)
+                    logger.info("Cache hit, reusing: %s", cached_path)
+                    return {"status": "success", "image_url": create_signed_url(cached_path), "seed": seed, "cached": True}
+
+        # The object key is known up front and presigning is local HMAC signing,
+        # so sign now rather than on the post-generation tail
+        file_path = new_output_path(user_id)
+        signed_url = create_signed_url(file_path)
+
+        logger.info("Generating image for prompt: %s (%d steps, guidance %s)", prompt, num_inference_steps, guidance_scale)
+        image = generate_images([prompt], num_inference_steps, guidance_scale, [seed])[0]
+
+        logger.info("Uploading generated image to: %s", file_path)
+        upload_future = upload_images([image], [file_path])[0]
+
+        if cache_key is not None:
+            output_cache[cache_key] = (file_path, upload_future)
+            if len(output_cache) > OUTPUT_CACHE_SIZE:
+                output_cache.popitem(last=False)
+
         logger.info("Generation complete.")
-        return {"status": "success", "image_url": signed_url}
+        return {"status": "success", "image_url": signed_url, "seed": seed}
 
     except ValidationError as e:
-        logger.error(f"Validation Error: {e.message}")
+        logger.error("Validation Error: %s", e.message)
         return {"error": e.message, "error_type": e.error_type}
+    except torch.cuda.OutOfMemoryError as e:
+        # The only failure worth handing cached blocks back to the driver for:
+        # the next job (possibly at a smaller size) can then allocate again
+        logger.error("CUDA out of memory: %s", e)
+        torch.cuda.empty_cache()
+        return {"error": "The GPU ran out of memory during generation. Try a smaller batch.", "error_type": "out_of_memory"}
     except Exception as e:
-        logger.error(f"Handler Error: {e}")
-        logger.error(traceback.format_exc())
-        return {"error": "An unexpected error occurred during generation."}
+        # The full trace stays in the worker log; the response only carries an
+        # id to find it by
+        error_id = uuid.uuid4().hex[:12]
+        logger.exception("Handler Error [%s]: %s", error_id, e)
+        return {"error": "An unexpected error occurred during generation.", "error_id": error_id}
 
-# Run the cold start initialization right away
+# Run the cold start initialization right away so the process is warm before
+# the first job arrives; it stays alive (and keeps the model loaded) across jobs
 initialize_worker()
 
 if __name__ == "__main__":
     logger.info("Starting RunPod serverless handler...")
-    start(handler)
\ No newline at end of file
+    # One job at a time: every job shares the single GPU-resident pipeline
+    start({"handler": handler, "concurrency_modifier": lambda current_concurrency: 1})
@@ -4,13 +4,17 @@ Test script for the AI headshot generation handler.
 This script tests the minimal fixes implemented in tasks 1-3.
 """
 
-import json
 import sys
-import os
 import traceback
-from unittest.mock import Mock, patch
+from unittest.mock import patch
 import logging
 
+try:
+    import pytest
+except ImportError:
+    # Only the per-case pytest items below need it; the script runner doesn't
+    pytest = None
+
 # Configure logging for testing
 logging.basicConfig(
     level=logging.INFO,
@@ -18,78 +22,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def test_validation_fixes():
-    """Test the request validation and input sanitization fixes"""
-    print("\n=== Testing Request Validation Fixes ===")
-    
-    # Import the handler module
-    try:
-        from handler import validate_request, sanitize_prompt, sanitize_user_id, ValidationError
-        print("✓ Successfully imported validation functions")
-    except ImportError as e:
-        print(f"✗ Failed to import validation functions: {e}")
-        return False
-    
-    # Test 1: Valid request
-    try:
-        valid_input = {
-            "prompt": "A professional headshot of a business person",
-            "user_id": "test_user_123"
-        }
-        prompt, user_id = validate_request(valid_input)
-        print(f"✓ Valid request processed: prompt='{prompt[:50]}...', user_id='{user_id}'")
-    except Exception as e:
-        print(f"✗ Valid request failed: {e}")
+# Import the handler module once for every test; importing it pulls in torch and
+# runs the cold start, so repeating the import per test only adds noise.
+# SystemExit is caught too because a failed cold start exits the process.
+try:
+    import handler as _h
+    HANDLER_IMPORT_ERROR = None
+except (ImportError, SystemExit) as e:
+    _h = None
+    HANDLER_IMPORT_ERROR = e
+
+def handler_module_available(what):
+    """Report whether the shared handler import succeeded"""
+    if _h is None:
+        print(f"✗ Failed to import {what}: {HANDLER_IMPORT_ERROR}")
         return False
-    
-    # Test 2: Missing prompt
+    print(f"✓ Successfully imported {what}")
+    return True
+
+# (input, should_pass, description) for validate_request
+VALIDATION_CASES = [
+    ({"prompt": "A professional headshot of a business person", "user_id": "test_user_123"}, True, "Valid request"),
+    ({"user_id": "test_user_123"}, False, "Missing prompt"),
+    ({"prompt": "A professional headshot"}, False, "Missing user_id"),
+    ({"prompt": "A" * 1001, "user_id": "test_user"}, False, "Long prompt"),  # Exceeds MAX_PROMPT_LENGTH
+    ({"prompt": "A professional headshot", "user_id": "user@domain.com"}, False, "Invalid user_id"),
+]
+
+def check_validation_case(job_input, should_pass, description):
+    """Run one validation case, reporting the outcome; returns whether it behaved as expected"""
     try:
-        invalid_input = {"user_id": "test_user_123"}
-        validate_request(invalid_input)
-        print("✗ Missing prompt should have failed")
-        return False
-    except ValidationError as e:
-        print(f"✓ Missing prompt correctly rejected: {e.message}")
+        prompt, user_id = _h.validate_request(job_input)
+    except _h.ValidationError as e:
+        if should_pass:
+            print(f"✗ {description} failed: {e.message}")
+            return False
+        print(f"✓ {description} correctly rejected: {e.message}")
+        return True
     except Exception as e:
-        print(f"✗ Unexpected error for missing prompt: {e}")
+        print(f"✗ Unexpected error for {description.lower()}: {e}")
         return False
-    
-    # Test 3: Missing user_id
-    try:
-        invalid_input = {"prompt": "A professional headshot"}
-        validate_request(invalid_input)
-        print("✗ Missing user_id should have failed")
-        return False
-    except ValidationError as e:
-        print(f"✓ Missing user_id correctly rejected: {e.message}")
-    except Exception as e:
-        print(f"✗ Unexpected error for missing user_id: {e}")
+
+    if not should_pass:
+        print(f"✗ {description} should have failed")
         return False
+    print(f"✓ {description} processed: prompt='{prompt[:50]}...', user_id='{user_id}'")
+    return True
+
+if pytest is not None:
+    @pytest.mark.parametrize("job_input,should_pass,description", VALIDATION_CASES)
+    def test_validate_request_case(job_input, should_pass, description):
+        """Each validation case as its own pytest item"""
+        if _h is None:
+            pytest.skip(f"handler could not be imported: {HANDLER_IMPORT_ERROR}")
+        assert check_validation_case(job_input, should_pass, description)
+
+def test_validation_fixes():
+    """Test the request validation and input sanitization fixes"""
+    print("\n=== Testing Request Validation Fixes ===")
     
-    # Test 4: Prompt too long
-    try:
-        long_prompt = "A" * 1001  # Exceeds MAX_PROMPT_LENGTH
-        invalid_input = {"prompt": long_prompt, "user_id": "test_user"}
-        validate_request(invalid_input)
-        print("✗ Long prompt should have failed")
-        return False
-    except ValidationError as e:
-        print(f"✓ Long prompt correctly rejected: {e.message}")
-    except Exception as e:
-        print(f"✗ Unexpected error for long prompt: {e}")
+    if not handler_module_available("validation functions"):
         return False
     
-    # Test 5: Invalid user_id characters
-    try:
-        invalid_input = {"prompt": "A professional headshot", "user_id": "user@domain.com"}
-        validate_request(invalid_input)
-        print("✗ Invalid user_id should have failed")
-        return False
-    except ValidationError as e:
-        print(f"✓ Invalid user_id correctly rejected: {e.message}")
-    except Exception as e:
-        print(f"✗ Unexpected error for invalid user_id: {e}")
-        return False
+    for job_input, should_pass, description in VALIDATION_CASES:
+        if not check_validation_case(job_input, should_pass, description):
+            return False
     
     print("✓ All validation tests passed")
     return True
@@ -98,48 +95,30 @@ def test_initialization_error_handling():
     """Test the initialization error handling fixes"""
     print("\n=== Testing Initialization Error Handling ===")
     
-    try:
-        from handler import initialize_worker
-        print("✓ Successfully imported initialize_worker function")
-    except ImportError as e:
-        print(f"✗ Failed to import initialize_worker: {e}")
+    if not handler_module_available("initialize_worker function"):
         return False
+    initialize_worker = _h.initialize_worker
     
-    # Test initialization without environment variables
-    original_env = {}
-    env_vars_to_test = ["SUPABASE_URL", "SUPABASE_SERVICE_KEY"]
-    
-    # Save original environment variables
-    for var in env_vars_to_test:
-        original_env[var] = os.environ.get(var)
-        if var in os.environ:
-            del os.environ[var]
-    
-    try:
-        # Test missing SUPABASE_URL
-        result = initialize_worker()
-        if result.get("success", True):
-            print("✗ Initialization should have failed without SUPABASE_URL")
-            return False
-        else:
-            print(f"✓ Initialization correctly failed without SUPABASE_URL: {result.get('error', 'Unknown error')}")
-        
-        # Test with SUPABASE_URL but missing SUPABASE_SERVICE_KEY
-        os.environ["SUPABASE_URL"] = "https://test.supabase.co"
-        result = initialize_worker()
-        if result.get("success", True):
-            print("✗ Initialization should have failed without SUPABASE_SERVICE_KEY")
-            return False
-        else:
-            print(f"✓ Initialization correctly failed without SUPABASE_SERVICE_KEY: {result.get('error', 'Unknown error')}")
-        
-    finally:
-        # Restore original environment variables
-        for var, value in original_env.items():
-            if value is not None:
-                os.environ[var] = value
-            elif var in os.environ:
-                del os.environ[var]
+    # initialize_worker checks the SUPABASE_* values read at import and returns
+    # early once a model is loaded, so patch those module globals (patch.object
+    # restores them on exit, even if a check raises). A failed cold start
+    # exits the process with status 1.
+    cases = [
+        ({"SUPABASE_URL": None}, "SUPABASE_URL"),
+        ({"SUPABASE_URL": "https://test.supabase.co", "SUPABASE_SERVICE_KEY": None}, "SUPABASE_SERVICE_KEY"),
+    ]
+    for overrides, missing in cases:
+        with patch.object(_h, "pipe", None), patch.multiple(_h, **overrides):
+            try:
+                initialize_worker()
+            except SystemExit as e:
+                if e.code != 1:
+                    print(f"✗ Initialization without {missing} exited with status {e.code}, expected 1")
+                    return False
+                print(f"✓ Initialization correctly exited without {missing}")
+            else:
+                print(f"✗ Initialization should have exited without {missing}")
+                return False
     
     print("✓ Initialization error handling tests passed")
     return True
@@ -148,12 +127,9 @@ def test_handler_error_responses():
     """Test that the handler returns proper error responses instead of crashing"""
     print("\n=== Testing Handler Error Response Behavior ===")
     
-    try:
-        from handler import handler
-        print("✓ Successfully imported handler function")
-    except ImportError as e:
-        print(f"✗ Failed to import handler: {e}")
+    if not handler_module_available("handler function"):
         return False
+    handler = _h.handler
     
     # Test 1: Invalid input format
     try:
@@ -210,12 +186,9 @@ def test_problematic_prompt():
     """Test with the same type of prompt that was causing crashes"""
     print("\n=== Testing with Problematic Prompt ===")
     
-    try:
-        from handler import handler
-        print("✓ Successfully imported handler function")
-    except ImportError as e:
-        print(f"✗ Failed to import handler: {e}")
+    if not handler_module_available("handler function"):
         return False
+    handler = _h.handler
     
     # Test with a prompt similar to what might have caused crashes
     problematic_prompts = [
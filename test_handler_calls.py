@@ -7,7 +7,41 @@ This uses mocking to simulate the environment without requiring actual dependenc
 import sys
 import os
 import json
+import functools
+import contextlib
+import importlib
+from concurrent.futures import Future
 from unittest.mock import Mock, patch, MagicMock
+from types import SimpleNamespace
+
+try:
+    import pytest
+except ImportError:
+    # Only the per-case pytest items below need it; the script runner doesn't
+    pytest = None
+
+# (input, should_pass, description) for validate_request
+VALIDATION_CASES = [
+    ({"prompt": "Test prompt", "user_id": "test_user"}, True, "Valid request"),
+    ({"user_id": "test_user"}, False, "Missing prompt"),
+    ({"prompt": "Test prompt"}, False, "Missing user_id"),
+    ({}, False, "Empty request"),
+    ({"prompt": "A" * 1001, "user_id": "test"}, False, "Long prompt"),
+    ({"prompt": "Test", "user_id": "user@domain.com"}, False, "Invalid user_id")
+]
+
+# ASCII prompts for comparing sanitize_prompt's str.translate fast path with the regex path
+ASCII_PROMPT_CASES = [
+    "A professional headshot, natural light!",
+    "A portrait <script>alert(1)</script>",
+    "Price: $5 & 50% off #tag @user",
+    "back`tick ~tilde ^caret |pipe {brace} [bracket] \\slash /slash *star +plus =eq",
+    "quotes 'single' \"double\" (parens); dash-ed",
+    "tabs\tand\nnewlines\x0bvertical\x0cfeed",
+    "file\x1cgroup\x1drecord\x1eunit\x1fseparators",
+    "  lots   of\r\n spaces  ",
+    "\x00\x07\x7f control characters",
+]
 
 def setup_mock_environment():
     """Set up a complete mock environment for testing"""
@@ -19,38 +53,74 @@ def setup_mock_environment():
         "SUPABASE_BUCKET_USER_UPLOADS": "user_uploads"
     })
     
+    return build_mock_modules()
+
+@functools.lru_cache(maxsize=1)
+def build_mock_modules():
+    """Build the mocked module graph once and share it between callers.
+
+    patch.dict only copies the sys.modules mapping, not these mocks: every
+    handler import sets attributes and records calls on the same objects.
+    Tests must therefore not assert on mock state; they patch attributes of
+    the imported handler module instead, which is fresh for every import.
+    """
+    
     # Create comprehensive mocks
     mocks = {}
     
-    # Mock torch
+    # Mock torch. The root stays a MagicMock so any attribute the handler
+    # touches at import resolves, but torch.cuda is only ever read, so it is a
+    # plain namespace with the answers baked in (no child-mock creation or
+    # call recording on every access). OutOfMemoryError has to be a real
+    # exception class because the handler names it in an except clause.
+    # The mocked GPU is an Ampere card, so the cold start runs to completion
+    # against the mocked pipeline (BF16, CPU offload below 24 GB).
     torch_mock = MagicMock()
-    torch_mock.cuda.is_available.return_value = False
-    torch_mock.cuda.device_count.return_value = 0
-    torch_mock.cuda.current_device.return_value = 0
-    torch_mock.cuda.get_device_name.return_value = "Mock GPU"
-    torch_mock.cuda.empty_cache = MagicMock()
-    torch_mock.cuda.memory_allocated.return_value = 0
-    torch_mock.cuda.memory_reserved.return_value = 0
-    
-    # Mock GPU properties
-    gpu_props = MagicMock()
-    gpu_props.total_memory = 16 * 1024**3  # 16GB
-    torch_mock.cuda.get_device_properties.return_value = gpu_props
+    torch_mock.cuda = SimpleNamespace(
+        is_available=lambda: True,
+        device_count=lambda: 1,
+        current_device=lambda: 0,
+        get_device_name=lambda device=None: "Mock GPU",
+        get_device_capability=lambda device=None: (8, 0),
+        synchronize=lambda device=None: None,
+        empty_cache=lambda: None,
+        memory_allocated=lambda device=None: 0,
+        memory_reserved=lambda device=None: 0,
+        get_device_properties=lambda device: SimpleNamespace(total_memory=16 * 1024**3),  # 16GB
+        OutOfMemoryError=type("OutOfMemoryError", (RuntimeError,), {}),
+    )
     torch_mock.device = MagicMock()
     torch_mock.bfloat16 = "bfloat16"
     
     mocks['torch'] = torch_mock
+    # Submodules the handler imports from directly need their own entries,
+    # otherwise the import system reports torch as "not a package"
+    mocks['torch.nn'] = torch_mock.nn
+    mocks['torch.nn.attention'] = torch_mock.nn.attention
+    
+    # Mock torchvision (GPU/libjpeg image encoding)
+    torchvision_mock = MagicMock()
+    mocks['torchvision'] = torchvision_mock
+    mocks['torchvision.io'] = torchvision_mock.io
+    
+    # Mock PIL
+    pil_mock = MagicMock()
+    mocks['PIL'] = pil_mock
+    mocks['PIL.Image'] = pil_mock.Image
     
     # Mock diffusers
     diffusers_mock = MagicMock()
     flux_pipeline_mock = MagicMock()
     diffusers_mock.FluxPipeline = flux_pipeline_mock
     mocks['diffusers'] = diffusers_mock
+    mocks['diffusers.models'] = diffusers_mock.models
+    mocks['diffusers.models.attention_processor'] = diffusers_mock.models.attention_processor
     
     # Mock runpod
     runpod_mock = MagicMock()
     runpod_mock.serverless.start = MagicMock()
     mocks['runpod'] = runpod_mock
+    mocks['runpod.serverless'] = runpod_mock.serverless
     
     # Mock boto3
     boto3_mock = MagicMock()
@@ -62,10 +132,33 @@ def setup_mock_environment():
     botocore_mock = MagicMock()
     config_mock = MagicMock()
     botocore_mock.config.Config = config_mock
-    mocks['botocore.config'] = botocore_mock
+    mocks['botocore'] = botocore_mock
+    mocks['botocore.config'] = botocore_mock.config
+    mocks['botocore.session'] = botocore_mock.session
     
     return mocks
 
+def import_handler():
+    """Import a fresh copy of handler.py; call with the mocked sys.modules in place"""
+    sys.modules.pop('handler', None)
+    return importlib.import_module('handler')
+
+@contextlib.contextmanager
+def mocked_handler():
+    """Yield handler.py imported (and cold-started) against the mocked dependencies"""
+    mocks = setup_mock_environment()
+    with patch.dict('sys.modules', mocks):
+        yield import_handler()
+
+def assert_rejected(h, error_type, call):
+    """Assert that call() raises a ValidationError with the given error_type"""
+    try:
+        call()
+    except h.ValidationError as e:
+        assert e.error_type == error_type, f"expected {error_type}, got {e.error_type}: {e.message}"
+    else:
+        raise AssertionError(f"expected a {error_type} ValidationError")
+
 def test_handler_with_mocks():
     """Test the handler with comprehensive mocking"""
     print("=== Testing Handler with Mocked Dependencies ===")
@@ -76,35 +169,36 @@ def test_handler_with_mocks():
     with patch.dict('sys.modules', mocks):
         try:
             # Import the handler after mocking
-            from handler import handler, initialize_worker, validate_request, ValidationError
+            h = import_handler()
+            handler, initialize_worker = h.handler, h.initialize_worker
+            validate_request, ValidationError = h.validate_request, h.ValidationError
             print("✓ Successfully imported handler with mocked dependencies")
-        except Exception as e:
+        except (Exception, SystemExit) as e:
+            # A failed cold start exits the process from inside the import
             print(f"✗ Failed to import handler: {e}")
             return False
         
-        # Test 1: Initialization (should fail gracefully without CUDA)
+        # Test 1: Initialization (the import already ran the cold start; calling
+        # it again must not reload the model)
         print("\n--- Test 1: Initialization ---")
+        if h.pipe is None or h.s3 is None:
+            print("✗ Cold start did not set up the pipeline and S3 client")
+            return False
+        print("✓ Cold start loaded the mocked pipeline and S3 client")
+        loaded_pipe = h.pipe
         try:
-            init_result = initialize_worker()
-            if isinstance(init_result, dict) and not init_result.get("success", True):
-                print(f"✓ Initialization failed gracefully: {init_result.get('error', 'Unknown error')[:100]}...")
-            else:
-                print(f"✗ Unexpected initialization result: {init_result}")
-                return False
-        except Exception as e:
-            print(f"✗ Initialization crashed: {e}")
+            initialize_worker()
+        except (Exception, SystemExit) as e:
+            print(f"✗ Repeated initialization crashed: {e}")
+            return False
+        if h.pipe is not loaded_pipe:
+            print("✗ Repeated initialization reloaded the model")
             return False
+        print("✓ Repeated initialization kept the loaded model")
         
         # Test 2: Request validation
         print("\n--- Test 2: Request Validation ---")
-        validation_tests = [
-            ({"prompt": "Test prompt", "user_id": "test_user"}, True, "Valid request"),
-            ({"user_id": "test_user"}, False, "Missing prompt"),
-            ({"prompt": "Test prompt"}, False, "Missing user_id"),
-            ({}, False, "Empty request"),
-            ({"prompt": "A" * 1001, "user_id": "test"}, False, "Long prompt"),
-            ({"prompt": "Test", "user_id": "user@domain.com"}, False, "Invalid user_id")
-        ]
+        validation_tests = VALIDATION_CASES
         
         validation_passed = 0
         for test_input, should_pass, description in validation_tests:
@@ -129,12 +223,16 @@ def test_handler_with_mocks():
         # Test 3: Handler with problematic inputs
         print("\n--- Test 3: Handler with Problematic Inputs ---")
         handler_tests = [
-            ({"input": {"prompt": "Test prompt", "user_id": "test_user"}}, "Valid input (will fail at model loading)"),
+            ({"input": {"prompt": "Test prompt", "user_id": "test_user"}}, "Valid input (mocked pipeline)"),
             ({"input": {"user_id": "test_user"}}, "Missing prompt"),
             ({"input": {"prompt": "Test prompt"}}, "Missing user_id"),
             ({"input": {}}, "Empty input"),
             ({}, "No input field"),
             ({"input": None}, "Null input"),
+            ({"input": {"prompts": ["Test prompt 1", "Test prompt 2"], "user_id": "test_user"}}, "Batch input (mocked pipeline)"),
+            ({"input": {"prompts": [], "user_id": "test_user"}}, "Empty prompt batch"),
+            ({"input": {"prompts": ["Test"] * 5, "user_id": "test_user"}}, "Oversized prompt batch"),
+            ({"input": {"warmup": True}}, "Warmup ping"),
         ]
         
         handler_passed = 0
@@ -166,6 +264,190 @@ def test_handler_with_mocks():
         print(f"\nOverall test results: {total_passed}/{total_tests} tests passed")
         return total_passed >= total_tests * 0.8  # 80% pass rate
 
+if pytest is not None:
+    @pytest.mark.parametrize("job_input,should_pass,description", VALIDATION_CASES)
+    def test_validate_request_case(job_input, should_pass, description):
+        """Each validation case as its own pytest item"""
+        with mocked_handler() as h:
+            if should_pass:
+                h.validate_request(job_input)
+            else:
+                with pytest.raises(h.ValidationError):
+                    h.validate_request(job_input)
+
+def check_ascii_prompt_fast_path(h, prompt):
+    """Assert that the translate table strips exactly what the regex does"""
+    assert prompt.isascii(), prompt
+    assert prompt.translate(h.PROMPT_ASCII_STRIP_TABLE) == h.PROMPT_DISALLOWED_CHARS_PATTERN.sub('', prompt), prompt
+    assert h.sanitize_prompt(prompt) == " ".join(h.PROMPT_DISALLOWED_CHARS_PATTERN.sub('', prompt).split()), prompt
+
+if pytest is not None:
+    @pytest.mark.parametrize("prompt", ASCII_PROMPT_CASES)
+    def test_ascii_prompt_fast_path_case(prompt):
+        """Each fast-path comparison as its own pytest item"""
+        with mocked_handler() as h:
+            check_ascii_prompt_fast_path(h, prompt)
+
+def test_ascii_prompt_fast_path():
+    """sanitize_prompt's ASCII translate table matches the regex path"""
+    with mocked_handler() as h:
+        for prompt in ASCII_PROMPT_CASES:
+            check_ascii_prompt_fast_path(h, prompt)
+        # Every ASCII character, in one prompt
+        check_ascii_prompt_fast_path(h, "x" + "".join(chr(i) for i in range(128)))
+    print("✓ ASCII prompt fast path")
+
+def test_batch_validation():
+    """validate_batch_request sanitizes every prompt and rejects malformed batches"""
+    with mocked_handler() as h:
+        prompts, user_id = h.validate_batch_request({"prompts": ["  A   portrait ", "B"], "user_id": "user_1"})
+        assert prompts == ["A portrait", "B"], prompts
+        assert user_id == "user_1", user_id
+
+        assert_rejected(h, "invalid_type", lambda: h.validate_batch_request({"prompts": [], "user_id": "u"}))
+        assert_rejected(h, "invalid_type", lambda: h.validate_batch_request({"prompts": "A", "user_id": "u"}))
+        assert_rejected(h, "batch_too_large", lambda: h.validate_batch_request({"prompts": ["A"] * (h.MAX_BATCH_SIZE + 1), "user_id": "u"}))
+        assert_rejected(h, "missing_field", lambda: h.validate_batch_request({"prompts": ["A"]}))
+    print("✓ Batch validation")
+
+def test_generation_params():
+    """parse_generation_params clamps steps, range-checks seeds and rejects non-numbers"""
+    with mocked_handler() as h:
+        assert h.parse_generation_params({"steps": 100, "seed": 5}) == (h.MAX_INFERENCE_STEPS, h.DEFAULT_GUIDANCE_SCALE, 5)
+        assert h.parse_generation_params({"steps": 0, "seed": 5})[0] == 1
+        assert h.parse_generation_params({"num_inference_steps": 20, "seed": 5})[0] == 20
+        assert h.parse_generation_params({"guidance_scale": "4.5", "seed": 5})[1] == 4.5
+
+        steps, _, seed = h.parse_generation_params({})
+        assert steps == h.DEFAULT_INFERENCE_STEPS, steps
+        assert 0 <= seed <= h.MAX_SEED, seed
+        # A batch's last image is seeded with seed + (n - 1)
+        assert h.parse_generation_params({"seed": h.MAX_SEED - 1}, 2)[2] == h.MAX_SEED - 1
+
+        assert_rejected(h, "validation_error", lambda: h.parse_generation_params({"steps": "many"}))
+        assert_rejected(h, "validation_error", lambda: h.parse_generation_params({"guidance_scale": None}))
+        assert_rejected(h, "validation_error", lambda: h.parse_generation_params({"seed": float("inf")}))
+        for guidance_scale in ["nan", float("inf"), -1, h.MAX_GUIDANCE_SCALE + 1]:
+            assert_rejected(h, "guidance_scale_out_of_range", lambda: h.parse_generation_params({"guidance_scale": guidance_scale}))
+        assert h.parse_generation_params({"guidance_scale": 0, "seed": 5})[1] == 0
+        assert_rejected(h, "seed_out_of_range", lambda: h.parse_generation_params({"seed": -1}))
+        assert_rejected(h, "seed_out_of_range", lambda: h.parse_generation_params({"seed": h.MAX_SEED + 1}))
+        assert_rejected(h, "seed_out_of_range", lambda: h.parse_generation_params({"seed": h.MAX_SEED}, 2))
+    print("✓ Generation parameter parsing")
+
+def test_lazy_validation_details():
+    """ValidationError only builds callable details when they are read, and only once"""
+    with mocked_handler() as h:
+        calls = []
+        error = h.ValidationError("Missing required field: 'prompt'", "missing_field", lambda: calls.append(1) or {"field": "prompt"})
+        assert not calls, "details were built eagerly"
+        assert error.details == {"field": "prompt"}
+        assert error.details == {"field": "prompt"}
+        assert len(calls) == 1, calls
+
+        assert h.ValidationError("No details").details == {}
+        try:
+            h.validate_request({"user_id": "u"})
+        except h.ValidationError as e:
+            assert e.details == {"field": "prompt", "provided_fields": ["user_id"]}, e.details
+        else:
+            raise AssertionError("validate_request accepted a job without a prompt")
+    print("✓ Lazy validation details")
+
+def test_cuda_graph_key():
+    """Empty option containers don't block graph capture; non-empty unhashable ones do"""
+    with mocked_handler() as h:
+        tensors = {"hidden_states": SimpleNamespace(shape=(1, 4096, 64), dtype="bfloat16")}
+        key = h.cuda_graph_key(tensors, {"joint_attention_kwargs": {}, "return_dict": False})
+        assert key is not None
+        assert key == h.cuda_graph_key(tensors, {"return_dict": False})
+        assert key != h.cuda_graph_key(tensors, {"return_dict": True})
+        assert h.cuda_graph_key(tensors, {"joint_attention_kwargs": {"scale": 1.0}}) is None
+    print("✓ CUDA graph keys")
+
+def finished_upload(error=None):
+    """A completed upload future, failed with error if given"""
+    upload_future = Future()
+    if error is None:
+        upload_future.set_result(None)
+    else:
+        upload_future.set_exception(error)
+    return upload_future
+
+@contextlib.contextmanager
+def mocked_generation(h):
+    """Stub out generation, upload and URL signing, yielding the generate_images mock"""
+    with patch.object(h, "generate_images", side_effect=lambda prompts, *args: [object() for _ in prompts]) as generate_images, \
+         patch.object(h, "upload_images", side_effect=lambda images, file_paths: [finished_upload() for _ in file_paths]), \
+         patch.object(h, "create_signed_url", side_effect=lambda file_path: f"https://storage.test/{file_path}"):
+        yield generate_images
+
+def test_batch_handler_responses():
+    """Batch jobs return one URL and seed per prompt, or a typed error"""
+    with mocked_handler() as h, mocked_generation(h) as generate_images:
+        result = h.handler({"input": {"prompts": ["A portrait", "B portrait"], "user_id": "user_1", "seed": 7}})
+        assert result["status"] == "success", result
+        assert [image["seed"] for image in result["images"]] == [7, 8], result
+        assert all(image["image_url"].startswith("https://storage.test/user_1/generated/") for image in result["images"]), result
+        assert len({image["image_url"] for image in result["images"]}) == 2, result
+        assert generate_images.call_args.args[0] == ["A portrait", "B portrait"]
+        h.upload_images.assert_called_once()
+
+        result = h.handler({"input": {"prompts": ["A"] * (h.MAX_BATCH_SIZE + 1), "user_id": "user_1"}})
+        assert result.get("error_type") == "batch_too_large", result
+        result = h.handler({"input": {"prompts": ["A", "B"], "user_id": "user_1", "seed": h.MAX_SEED}})
+        assert result.get("error_type") == "seed_out_of_range", result
+        assert h.handler({"input": {"warmup": True}}) == {"status": "warm"}
+    print("✓ Batch handler responses")
+
+def test_output_cache():
+    """A repeated explicitly seeded job is served from the output cache; unseeded jobs never are"""
+    with mocked_handler() as h, mocked_generation(h) as generate_images:
+        job = {"input": {"prompt": "A portrait", "user_id": "user_1", "seed": 42}}
+        first = h.handler(job)
+        assert first["status"] == "success" and "cached" not in first, first
+        second = h.handler(job)
+        assert second.get("cached") is True, second
+        assert second["image_url"] == first["image_url"] and second["seed"] == 42, second
+        assert generate_images.call_count == 1, generate_images.call_count
+
+        unseeded = {"input": {"prompt": "A portrait", "user_id": "user_1"}}
+        h.handler(unseeded)
+        assert "cached" not in h.handler(unseeded)
+        assert generate_images.call_count == 3, generate_images.call_count
+
+        # A failed (background) upload must not be served from the cache
+        failed = {"input": {"prompt": "A portrait", "user_id": "user_1", "seed": 43}}
+        h.upload_images.side_effect = lambda images, file_paths: [finished_upload(OSError("upload failed")) for _ in file_paths]
+        h.handler(failed)
+        h.upload_images.side_effect = lambda images, file_paths: [finished_upload() for _ in file_paths]
+        assert "cached" not in h.handler(failed)
+        assert h.handler(failed).get("cached") is True
+        assert generate_images.call_count == 5, generate_images.call_count
+    print("✓ Output cache")
+
+ASSERTION_TESTS = [
+    test_ascii_prompt_fast_path,
+    test_batch_validation,
+    test_generation_params,
+    test_lazy_validation_details,
+    test_cuda_graph_key,
+    test_batch_handler_responses,
+    test_output_cache,
+]
+
+def run_assertion_tests():
+    """Run the assertion-based tests, reporting each; returns whether all passed"""
+    print("\n=== Testing Handler Logic with Mocked Generation ===")
+    passed = True
+    for test in ASSERTION_TESTS:
+        try:
+            test()
+        except Exception as e:
+            print(f"✗ {test.__name__} failed: {e!r}")
+            passed = False
+    return passed
+
 def main():
     """Run the handler testing with mocks"""
     print("Testing AI Headshot Generation Handler with Mocked Dependencies")
@@ -173,15 +455,17 @@ def main():
     
     try:
         success = test_handler_with_mocks()
+        success = run_assertion_tests() and success
         
         if success:
             print("\n🎉 HANDLER TESTING SUCCESSFUL!")
             print("\nKey findings:")
             print("- ✓ Handler imports successfully with mocked dependencies")
-            print("- ✓ Initialization fails gracefully without crashing")
+            print("- ✓ Cold start completes once and is not repeated")
             print("- ✓ Request validation works correctly")
             print("- ✓ Handler returns structured responses for all inputs")
             print("- ✓ No crashes or unhandled exceptions")
+            print("- ✓ Batch, generation parameter and output cache logic behave as specified")
             print("\nThe handler is ready for deployment testing!")
             
         else:
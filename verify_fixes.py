@@ -5,28 +5,179 @@ This verifies that all the minimal fixes from tasks 1-3 are properly implemented
 and that the handler is ready for deployment testing.
 """
 
-import re
+import ast
 import json
+import os
 import sys
+import hashlib
+import functools
+
+# Digest of the last handler.py (and checks) that passed every verification
+VERIFY_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".verify_cache.json")
+
+@functools.lru_cache(maxsize=1)
+def load_handler_source():
+    """Read handler.py once for all of the task verifications"""
+    with open('handler.py', 'r', encoding='utf-8') as f:
+        return f.read()
+
+def _dotted_name(node):
+    """Return 'a.b.c' for Name/Attribute chains, or None for anything else"""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = _dotted_name(node.value)
+        return f"{parent}.{node.attr}" if parent else None
+    return None
+
+class HandlerIndex:
+    """Everything the checks look at, collected in one walk over handler.py's AST"""
+
+    def __init__(self, tree):
+        self.functions = {}
+        self.classes = {}
+        self.calls = []
+        self.names = set()
+        self.assignments = []
+        self.returned_dicts = []
+        self.except_handlers = []
+        self.none_checks = set()
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.FunctionDef):
+                self.functions[node.name] = node
+            elif isinstance(node, ast.ClassDef):
+                self.classes[node.name] = node
+            elif isinstance(node, ast.Call):
+                self.calls.append(node)
+            elif isinstance(node, ast.Name):
+                self.names.add(node.id)
+            elif isinstance(node, ast.Attribute):
+                self.names.add(node.attr)
+            elif isinstance(node, ast.Assign):
+                self.assignments.append(node)
+            elif isinstance(node, ast.Return) and isinstance(node.value, ast.Dict):
+                self.returned_dicts.append(node.value)
+            elif isinstance(node, ast.ExceptHandler):
+                self.except_handlers.append(node)
+            elif isinstance(node, ast.Compare) and any(isinstance(op, ast.Is) for op in node.ops):
+                if isinstance(node.left, ast.Name) and any(
+                    isinstance(c, ast.Constant) and c.value is None for c in node.comparators
+                ):
+                    self.none_checks.add(node.left.id)
+
+    def calls_to(self, *names):
+        return [call for call in self.calls if _dotted_name(call.func) in names]
+
+    def function_contains(self, function_name, node_type):
+        function = self.functions.get(function_name)
+        return function is not None and any(isinstance(node, node_type) for node in ast.walk(function))
+
+    def returns_dict_with(self, key, value=..., function_name=None):
+        if function_name is None:
+            returned_dicts = self.returned_dicts
+        elif function_name in self.functions:
+            returned_dicts = [
+                node.value for node in ast.walk(self.functions[function_name])
+                if isinstance(node, ast.Return) and isinstance(node.value, ast.Dict)
+            ]
+        else:
+            returned_dicts = []
+
+        for returned in returned_dicts:
+            for dict_key, dict_value in zip(returned.keys, returned.values):
+                if isinstance(dict_key, ast.Constant) and dict_key.value == key:
+                    if value is ... or (isinstance(dict_value, ast.Constant) and dict_value.value is value):
+                        return True
+        return False
+
+    def handler_returns(self, dict_only):
+        for except_handler in self.except_handlers:
+            for node in ast.walk(except_handler):
+                if isinstance(node, ast.Return) and (not dict_only or isinstance(node.value, ast.Dict)):
+                    return True
+        return False
+
+@functools.lru_cache(maxsize=1)
+def load_handler_index():
+    """Parse handler.py once and index it for all of the task verifications"""
+    return HandlerIndex(ast.parse(load_handler_source()))
+
+def _assigned_from_getenv(index, target_name):
+    for assignment in index.assignments:
+        targets = {_dotted_name(target) for target in assignment.targets}
+        if target_name in targets and isinstance(assignment.value, ast.Call):
+            if _dotted_name(assignment.value.func) in ("os.getenv", "os.environ.get"):
+                return True
+    return False
+
+def _pipe_called_with_prompt(index):
+    return any(
+        any(keyword.arg and "prompt" in keyword.arg for keyword in call.keywords)
+        for call in index.calls_to("pipe")
+    )
+
+def _job_input_read(index):
+    return any(
+        call.args and isinstance(call.args[0], ast.Constant) and call.args[0].value == "input"
+        for call in index.calls_to("job.get")
+    )
+
+def _defined_with_arguments(index, function_name, *argument_names):
+    function = index.functions.get(function_name)
+    return function is not None and [arg.arg for arg in function.args.args] == list(argument_names)
+
+TASK1_CHECKS = [
+    ("Try-catch wrapper in handler", lambda index: index.function_contains("handler", ast.Try), "Main handler function wrapped in try-catch"),
+    ("Exception handling with return", lambda index: index.handler_returns(dict_only=True), "Exceptions return error responses instead of raising"),
+    ("GPU memory cleanup", lambda index: bool(index.calls_to("torch.cuda.empty_cache")), "GPU memory cleanup after operations"),
+    ("Logging for errors", lambda index: bool(index.calls_to("logger.error", "logger.exception", "logger.info")), "Error logging for debugging"),
+    ("Structured error responses", lambda index: index.returns_dict_with("error"), "Returns structured error responses")
+]
+
+TASK2_CHECKS = [
+    ("Initialize worker function", lambda index: _defined_with_arguments(index, "initialize_worker"), "Worker initialization function exists"),
+    ("Environment variable validation", lambda index: _assigned_from_getenv(index, "SUPABASE_URL"), "Environment variables validated"),
+    ("CUDA availability check", lambda index: bool(index.calls_to("torch.cuda.is_available")), "CUDA availability checked"),
+    ("Memory availability check", lambda index: bool({"total_memory", "available_memory"} & index.names), "Memory availability checked before loading"),
+    ("Structured init error responses", lambda index: index.returns_dict_with("success", False), "Returns structured error responses on init failure"),
+    ("No process crash on init failure", lambda index: index.returns_dict_with("error", function_name="initialize_worker"), "Initialization failures return errors instead of crashing")
+]
+
+TASK3_CHECKS = [
+    ("Request validation function", lambda index: "validate_request" in index.functions, "Request validation function exists"),
+    ("Required field validation", lambda index: bool({"prompt", "user_id"} & index.none_checks), "Validates required fields (prompt, user_id)"),
+    ("Prompt sanitization", lambda index: "sanitize_prompt" in index.functions, "Prompt sanitization function exists"),
+    ("User ID sanitization", lambda index: "sanitize_user_id" in index.functions, "User ID sanitization function exists"),
+    ("File path sanitization", lambda index: "sanitize_file_path" in index.functions, "File path sanitization to prevent directory traversal"),
+    ("Prompt length limits", lambda index: bool({"MAX_PROMPT_LENGTH", "MIN_PROMPT_LENGTH"} & index.names), "Prompt length limits defined"),
+    ("User ID pattern validation", lambda index: "ALLOWED_USER_ID_PATTERN" in index.names, "User ID pattern validation"),
+    ("ValidationError class", lambda index: "ValidationError" in index.classes and any(
+        _dotted_name(base) == "Exception" for base in index.classes["ValidationError"].bases
+    ), "Custom ValidationError class defined")
+]
+
+# Check that the handler is ready for testing with problematic prompts
+TASK4_CHECKS = [
+    ("Handler function exists", lambda index: _defined_with_arguments(index, "handler", "job"), "Main handler function exists"),
+    ("Input processing", _job_input_read, "Processes job input"),
+    ("Error response format", lambda index: index.returns_dict_with("error"), "Returns properly formatted error responses"),
+    ("No unhandled exceptions", lambda index: index.handler_returns(dict_only=False), "All exceptions are caught and handled"),
+    ("Worker stays alive", lambda index: bool(index.returned_dicts), "Returns responses instead of crashing"),
+    ("Requirement 1.1 compliance", _pipe_called_with_prompt, "Generates images from prompts (Req 1.1)"),
+    ("Requirement 1.4 compliance", lambda index: index.returns_dict_with("error"), "Returns error messages without crashing (Req 1.4)")
+]
 
 def verify_task_1_fixes():
     """Verify Task 1: Add basic error handling to prevent worker crashes"""
     print("=== Verifying Task 1: Basic Error Handling ===")
     
-    with open('handler.py', 'r') as f:
-        code = f.read()
-    
-    checks = [
-        ("Try-catch wrapper in handler", r'def handler\(.*?\):.*?try:', "Main handler function wrapped in try-catch"),
-        ("Exception handling with return", r'except.*?Exception.*?:.*?return\s*{', "Exceptions return error responses instead of raising"),
-        ("GPU memory cleanup", r'torch\.cuda\.empty_cache\(\)', "GPU memory cleanup after operations"),
-        ("Logging for errors", r'logger\.(error|info)', "Error logging for debugging"),
-        ("Structured error responses", r'return\s*{[^}]*"error"', "Returns structured error responses")
-    ]
+    index = load_handler_index()
     
+    checks = TASK1_CHECKS
     passed = 0
-    for check_name, pattern, description in checks:
-        if re.search(pattern, code, re.DOTALL | re.MULTILINE):
+    for check_name, check, description in checks:
+        if check(index):
             print(f"✓ {check_name}")
             passed += 1
         else:
@@ -39,21 +190,12 @@ def verify_task_2_fixes():
     """Verify Task 2: Fix initialization error handling"""
     print("\n=== Verifying Task 2: Initialization Error Handling ===")
     
-    with open('handler.py', 'r') as f:
-        code = f.read()
-    
-    checks = [
-        ("Initialize worker function", r'def initialize_worker\(\):', "Worker initialization function exists"),
-        ("Environment variable validation", r'SUPABASE_URL.*?os\.getenv', "Environment variables validated"),
-        ("CUDA availability check", r'torch\.cuda\.is_available\(\)', "CUDA availability checked"),
-        ("Memory availability check", r'total_memory|available_memory', "Memory availability checked before loading"),
-        ("Structured init error responses", r'return\s*{[^}]*"success":\s*False', "Returns structured error responses on init failure"),
-        ("No process crash on init failure", r'initialize_worker.*?return.*?{.*?"error"', "Initialization failures return errors instead of crashing")
-    ]
+    index = load_handler_index()
     
+    checks = TASK2_CHECKS
     passed = 0
-    for check_name, pattern, description in checks:
-        if re.search(pattern, code, re.DOTALL | re.MULTILINE):
+    for check_name, check, description in checks:
+        if check(index):
             print(f"✓ {check_name}")
             passed += 1
         else:
@@ -66,23 +208,12 @@ def verify_task_3_fixes():
     """Verify Task 3: Add request validation and input sanitization"""
     print("\n=== Verifying Task 3: Request Validation and Input Sanitization ===")
     
-    with open('handler.py', 'r') as f:
-        code = f.read()
-    
-    checks = [
-        ("Request validation function", r'def validate_request\(', "Request validation function exists"),
-        ("Required field validation", r'prompt.*?is None|user_id.*?is None', "Validates required fields (prompt, user_id)"),
-        ("Prompt sanitization", r'def sanitize_prompt\(', "Prompt sanitization function exists"),
-        ("User ID sanitization", r'def sanitize_user_id\(', "User ID sanitization function exists"),
-        ("File path sanitization", r'def sanitize_file_path\(', "File path sanitization to prevent directory traversal"),
-        ("Prompt length limits", r'MAX_PROMPT_LENGTH|MIN_PROMPT_LENGTH', "Prompt length limits defined"),
-        ("User ID pattern validation", r'ALLOWED_USER_ID_PATTERN', "User ID pattern validation"),
-        ("ValidationError class", r'class ValidationError\(Exception\)', "Custom ValidationError class defined")
-    ]
+    index = load_handler_index()
     
+    checks = TASK3_CHECKS
     passed = 0
-    for check_name, pattern, description in checks:
-        if re.search(pattern, code, re.DOTALL | re.MULTILINE):
+    for check_name, check, description in checks:
+        if check(index):
             print(f"✓ {check_name}")
             passed += 1
         else:
@@ -95,23 +226,12 @@ def verify_task_4_requirements():
     """Verify Task 4: Test readiness and requirement compliance"""
     print("\n=== Verifying Task 4: Test Readiness ===")
     
-    with open('handler.py', 'r') as f:
-        code = f.read()
-    
-    # Check that the handler is ready for testing with problematic prompts
-    checks = [
-        ("Handler function exists", r'def handler\(job\):', "Main handler function exists"),
-        ("Input processing", r'job\.get\("input"', "Processes job input"),
-        ("Error response format", r'return\s*{[^}]*"error".*?}', "Returns properly formatted error responses"),
-        ("No unhandled exceptions", r'except.*?Exception.*?:.*?return', "All exceptions are caught and handled"),
-        ("Worker stays alive", r'return\s*{.*?}', "Returns responses instead of crashing"),
-        ("Requirement 1.1 compliance", r'pipe\(.*?prompt.*?\)', "Generates images from prompts (Req 1.1)"),
-        ("Requirement 1.4 compliance", r'return.*?"error"', "Returns error messages without crashing (Req 1.4)")
-    ]
+    index = load_handler_index()
     
+    checks = TASK4_CHECKS
     passed = 0
-    for check_name, pattern, description in checks:
-        if re.search(pattern, code, re.DOTALL | re.MULTILINE):
+    for check_name, check, description in checks:
+        if check(index):
             print(f"✓ {check_name}")
             passed += 1
         else:
@@ -176,11 +296,52 @@ def simulate_problematic_requests():
     print("✓ Provide detailed error information")
     print("✓ Log errors for debugging")
 
+def verification_digest():
+    """Hash of handler.py and of this script, so edits to either invalidate the cache"""
+    with open(os.path.abspath(__file__), 'rb') as f:
+        checks_source = f.read()
+    return hashlib.sha256(load_handler_source().encode('utf-8') + b"\0" + checks_source).hexdigest()
+
+def load_verify_cache():
+    try:
+        with open(VERIFY_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_verify_cache(cache):
+    try:
+        with open(VERIFY_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"(could not write {VERIFY_CACHE_PATH}: {e})")
+
+def report_verified():
+    """Print the deployment summary once every task is verified"""
+    print("🎉 ALL FIXES VERIFIED! Handler is ready for deployment testing.")
+    create_deployment_summary()
+    simulate_problematic_requests()
+    
+    print("\n" + "=" * 60)
+    print("NEXT STEPS:")
+    print("1. Deploy the updated handler to your Runpod environment")
+    print("2. Test with the same prompts that were causing crashes")
+    print("3. Verify worker stays alive and returns proper error responses")
+    print("4. Monitor logs for detailed error information")
+
 def main():
     """Run complete verification of all fixes"""
     print("Verifying AI Headshot Generation Handler Fixes")
     print("=" * 60)
     
+    # Skip the checks entirely when this exact handler.py already passed them
+    digest = verification_digest()
+    cache = load_verify_cache()
+    if cache.get(digest) == "PASS":
+        print("handler.py is unchanged since it last passed verification; skipping checks.")
+        report_verified()
+        return True
+    
     tasks = [
         ("Task 1: Basic Error Handling", verify_task_1_fixes),
         ("Task 2: Initialization Error Handling", verify_task_2_fixes),
@@ -205,17 +366,8 @@ def main():
     print(f"VERIFICATION RESULTS: {passed_tasks}/{total_tasks} tasks completed")
     
     if passed_tasks == total_tasks:
-        print("🎉 ALL FIXES VERIFIED! Handler is ready for deployment testing.")
-        create_deployment_summary()
-        simulate_problematic_requests()
-        
-        print("\n" + "=" * 60)
-        print("NEXT STEPS:")
-        print("1. Deploy the updated handler to your Runpod environment")
-        print("2. Test with the same prompts that were causing crashes")
-        print("3. Verify worker stays alive and returns proper error responses")
-        print("4. Monitor logs for detailed error information")
-        
+        save_verify_cache({digest: "PASS"})
+        report_verified()
         return True
     else:
         print(f"❌ {total_tasks - passed_tasks} tasks need attention before deployment.")